@@ -1,6 +1,17 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, make_response
+import calendar
+import hashlib
+import json
 import os
+import re
+import threading
+from contextlib import contextmanager
 from datetime import datetime, date
+from pathlib import Path
+from sqlalchemy import (Column, ForeignKey, Index, Integer, MetaData, SmallInteger,
+                        Table, Text, UniqueConstraint, bindparam, create_engine, inspect,
+                        literal_column, make_url, select, text)
+from sqlalchemy.dialects import postgresql, sqlite
 
 app = Flask(__name__,
             template_folder='../templates',
@@ -9,251 +20,365 @@ app = Flask(__name__,
 # Detect if running on Vercel (production) or locally (development)
 USE_POSTGRES = 'POSTGRES_URL' in os.environ
 
+# Process-wide engine: connections are checked out of the pool per request
+# instead of being opened and closed every time
 if USE_POSTGRES:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
+    # Vercel hands out postgres:// URLs; SQLAlchemy wants postgresql:// plus
+    # the driver name. psycopg 3 prepares repeated statements automatically.
+    postgres_url = make_url(os.environ['POSTGRES_URL'].replace('postgres://', 'postgresql://', 1))
+    engine = create_engine(postgres_url.set(drivername='postgresql+psycopg'),
+                           # Enough to serve a gevent worker's concurrent requests
+                           pool_size=10,
+                           max_overflow=10,
+                           pool_pre_ping=True)
 else:
-    import sqlite3
+    # File databases get the default QueuePool: one sqlite3 connection per
+    # thread at a time, never a single connection shared between threads
+    engine = create_engine('sqlite:///habit_tracker.db',
+                           connect_args={'check_same_thread': False})
+
+# Database schema, defined once with SQLAlchemy Core and compiled per backend
+
+HABIT_NUMBERS = range(1, 6)
+DAYS = range(1, 32)
+
+
+def is_valid_number(value, numbers):
+    """Whether a JSON value is an int in numbers; `in range` alone also
+    accepts floats like 1.0 and True"""
+    return type(value) is int and value in numbers
+
+
+metadata = MetaData()
+
+
+# Months table
+months = Table('months', metadata,
+               Column('id', Integer, primary_key=True),
+               Column('year', Integer, nullable=False),
+               Column('month', Integer, nullable=False),
+               Column('best_day', Integer),
+               # Bumped by every save to the month; feeds the page's ETag
+               Column('revision', Integer, server_default=text('0')),
+               UniqueConstraint('year', 'month'),
+               Index('idx_months_ym', 'year', 'month', unique=True),
+               sqlite_autoincrement=True)
+
+# Habits table (5 habits per month)
+habits = Table('habits', metadata,
+               Column('id', Integer, primary_key=True),
+               Column('month_id', Integer, ForeignKey('months.id', ondelete='CASCADE')),
+               Column('habit_number', Integer, nullable=False),
+               Column('habit_name', Text),
+               UniqueConstraint('month_id', 'habit_number'),
+               Index('idx_habits_month_num', 'month_id', 'habit_number'),
+               sqlite_autoincrement=True)
+
+# Daily entries table
+daily_entries = Table('daily_entries', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('month_id', Integer, ForeignKey('months.id', ondelete='CASCADE')),
+                      Column('day', Integer, nullable=False),
+                      Column('one_liner', Text),
+                      Column('detailed_journal', Text),
+                      Column('word_count', Integer, server_default=text('0')),
+                      # Bit n-1 is set when habit n was done that day
+                      Column('habits_mask', SmallInteger, server_default=text('0')),
+                      UniqueConstraint('month_id', 'day'),
+                      Index('idx_daily_entries_month_day', 'month_id', 'day'),
+                      sqlite_autoincrement=True)
+
+# Both dialects implement INSERT ... ON CONFLICT with the same API
+dialect_insert = postgresql.insert if USE_POSTGRES else sqlite.insert
 
 # Database connection
 
 
-def get_db_connection():
-    if USE_POSTGRES:
-        conn = psycopg2.connect(os.environ.get('POSTGRES_URL'))
-        return conn
-    else:
-        conn = sqlite3.connect('habit_tracker.db')
-        conn.row_factory = sqlite3.Row
-        return conn
+@contextmanager
+def db_cursor():
+    """Borrow a pooled connection wrapped in a transaction (committed on exit)"""
+    with engine.begin() as conn:
+        yield conn
+
+
+# Same pool, but reads run in autocommit mode: no BEGIN/COMMIT roundtrips
+# and no transaction left open on a pooled connection
+read_engine = engine.execution_options(isolation_level='AUTOCOMMIT')
+
+
+@contextmanager
+def db_reader():
+    """Borrow a pooled connection for SELECT-only work (nothing to commit)"""
+    with read_engine.connect() as conn:
+        yield conn
+
+# Month data cache (optional, only used when REDIS_URL is set)
+
+USE_REDIS = 'REDIS_URL' in os.environ
+MONTH_DATA_TTL = 3600
+# Bump when the cached month data changes shape, so old entries are never read
+MONTH_DATA_VERSION = 2
+
+if USE_REDIS:
+    import redis
+    redis_client = redis.Redis.from_url(os.environ['REDIS_URL'])
 
-# Helper function for safe day name calculation
 
+def month_data_key(year, month, etag):
+    """Keyed by the page's ETag: a save moves readers to a new key instead
+    of having to delete the old one, which just expires"""
+    return f'mdata:v{MONTH_DATA_VERSION}:{year}:{month}:{etag}'
 
-def get_day_name(year, month, day):
-    """Safely get day name, return empty string if invalid date"""
+
+def get_cached_month_data(year, month, etag):
+    if not USE_REDIS:
+        return None
+    try:
+        cached = redis_client.get(month_data_key(year, month, etag))
+    except redis.RedisError:
+        # The database stays the source of truth if Redis is unavailable
+        return None
+    return json.loads(cached) if cached else None
+
+
+def cache_month_data(year, month, etag, data):
+    if not USE_REDIS:
+        return
     try:
-        date_obj = date(year, month, day)
-        return ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'][date_obj.weekday()]
-    except ValueError:
-        return ''
+        redis_client.setex(month_data_key(year, month, etag), MONTH_DATA_TTL, json.dumps(data))
+    except redis.RedisError:
+        pass
+
+# Day names for a month
+
+DAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+
+def get_day_names(year, month):
+    """Map day 1-31 to its day name, empty string for days the month doesn't have"""
+    if not 1 <= month <= 12:
+        return {day: '' for day in range(1, 32)}
+    first_weekday, days_in_month = calendar.monthrange(year, month)
+    return {day: DAY_NAMES[(first_weekday + day - 1) % 7] if day <= days_in_month else ''
+            for day in range(1, 32)}
 
 # Initialize database tables
 
 
 def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-
     try:
-        if USE_POSTGRES:
-            # Months table
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS months (
-                    id SERIAL PRIMARY KEY,
-                    year INTEGER NOT NULL,
-                    month INTEGER NOT NULL,
-                    best_day INTEGER,
-                    UNIQUE(year, month)
-                )
-            ''')
-
-            # Habits table (5 habits per month)
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS habits (
-                    id SERIAL PRIMARY KEY,
-                    month_id INTEGER REFERENCES months(id) ON DELETE CASCADE,
-                    habit_number INTEGER NOT NULL,
-                    habit_name TEXT,
-                    UNIQUE(month_id, habit_number)
-                )
-            ''')
-
-            # Daily entries table
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS daily_entries (
-                    id SERIAL PRIMARY KEY,
-                    month_id INTEGER REFERENCES months(id) ON DELETE CASCADE,
-                    day INTEGER NOT NULL,
-                    one_liner TEXT,
-                    detailed_journal TEXT,
-                    word_count INTEGER DEFAULT 0,
-                    habit1 INTEGER DEFAULT 0,
-                    habit2 INTEGER DEFAULT 0,
-                    habit3 INTEGER DEFAULT 0,
-                    habit4 INTEGER DEFAULT 0,
-                    habit5 INTEGER DEFAULT 0,
-                    UNIQUE(month_id, day),
-                    FOREIGN KEY (month_id) REFERENCES months(id) ON DELETE CASCADE
-                )
-            ''')
-        else:
-            # SQLite version - same as before
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS months (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    year INTEGER NOT NULL,
-                    month INTEGER NOT NULL,
-                    best_day INTEGER,
-                    UNIQUE(year, month)
-                )
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS habits (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    month_id INTEGER,
-                    habit_number INTEGER NOT NULL,
-                    habit_name TEXT,
-                    UNIQUE(month_id, habit_number),
-                    FOREIGN KEY (month_id) REFERENCES months(id) ON DELETE CASCADE
-                )
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS daily_entries (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    month_id INTEGER,
-                    day INTEGER NOT NULL,
-                    one_liner TEXT,
-                    detailed_journal TEXT,
-                    word_count INTEGER DEFAULT 0,
-                    habit1 INTEGER DEFAULT 0,
-                    habit2 INTEGER DEFAULT 0,
-                    habit3 INTEGER DEFAULT 0,
-                    habit4 INTEGER DEFAULT 0,
-                    habit5 INTEGER DEFAULT 0,
-                    UNIQUE(month_id, day),
-                    FOREIGN KEY (month_id) REFERENCES months(id) ON DELETE CASCADE
-                )
-            ''')
-
-        conn.commit()
-    except Exception as e:
-        # Silently ignore errors if tables already exist
-        conn.rollback()
-    finally:
-        conn.close()
+        with db_cursor() as conn:
+            inspector = inspect(conn)
+            new_tables = {table.name for table in metadata.sorted_tables
+                          if not inspector.has_table(table.name)}
+            metadata.create_all(conn)
+
+            # Bring tables created by older versions up to date
+            inspector = inspect(conn)
+            for table in metadata.sorted_tables:
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing:
+                        column_type = column.type.compile(dialect=conn.dialect)
+                        default = (f' DEFAULT {column.server_default.arg.text}'
+                                   if column.server_default is not None else '')
+                        conn.execute(text(
+                            f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}'))
+
+                # Fold the old habit1..habit5 columns into habits_mask
+                legacy_habits = [i for i in HABIT_NUMBERS if f'habit{i}' in existing]
+                if table is daily_entries and legacy_habits:
+                    conn.execute(text('UPDATE daily_entries SET habits_mask = ' + ' | '.join(
+                        f'(COALESCE(habit{i}, 0) << {i - 1})' for i in legacy_habits)))
+                    for i in legacy_habits:
+                        conn.execute(text(f'ALTER TABLE daily_entries DROP COLUMN habit{i}'))
+
+            # create_all() only creates indexes along with new tables
+            for table in metadata.sorted_tables:
+                existing = {index['name'] for index in inspector.get_indexes(table.name)}
+                missing = [index for index in table.indexes if index.name not in existing]
+                for index in missing:
+                    index.create(conn)
+                # Refresh planner statistics so new indexes get picked; a warm
+                # start with nothing created skips this
+                if table.name in new_tables or missing:
+                    conn.execute(text(f'ANALYZE {table.name}'))
+    except Exception:
+        # The transaction is rolled back, so the app still starts on the old
+        # schema; log why (e.g. a concurrent cold start or a failed migration)
+        app.logger.exception('Database initialization failed')
+
+
+# Create tables once per process (per container on Vercel), not on every page load
+init_db()
 
 # Get or create month
 
+# A new month starts with 5 default habits; daily entries are only
+# written once a day is actually saved
+SEED_HABITS = habits.insert().values(
+    [{'month_id': bindparam('new_month_id'), 'habit_number': i, 'habit_name': f'Habit {i}'}
+     for i in HABIT_NUMBERS])
+
+# What the page shows for a day that has no row yet
+EMPTY_ENTRY = {'one_liner': '', 'detailed_journal': '', 'word_count': 0, 'habits_mask': 0}
+
+# Insert-or-fetch in a single statement; `created` tells whether to seed the month
+if USE_POSTGRES:
+    _upsert_month = dialect_insert(months)
+    UPSERT_MONTH = _upsert_month.on_conflict_do_update(
+        index_elements=['year', 'month'],
+        set_={'year': _upsert_month.excluded.year},
+    ).returning(months.c.id, literal_column('xmax = 0').label('created'))
+else:
+    # SQLite has no xmax, so only a freshly inserted row comes back
+    UPSERT_MONTH = dialect_insert(months).on_conflict_do_nothing(
+        index_elements=['year', 'month'],
+    ).returning(months.c.id, literal_column('1').label('created'))
+
 
-def get_or_create_month(year, month):
-    conn = get_db_connection()
-    cur = conn.cursor()
+# (year, month) -> month id; a month row is never re-keyed, so entries stay valid
+_MONTH_ID_CACHE = {}
+_MONTH_ID_CACHE_LOCK = threading.Lock()
 
-    if USE_POSTGRES:
-        cur.execute(
-            'SELECT * FROM months WHERE year = %s AND month = %s', (year, month))
-        month_record = cur.fetchone()
 
-        if not month_record:
-            cur.execute(
-                'INSERT INTO months (year, month) VALUES (%s, %s) RETURNING id', (year, month))
-            month_id = cur.fetchone()[0]
+def get_or_create_month(conn, year, month):
+    """Resolve a month id on the caller's connection, so the lookup and the
+    caller's own statements share one checkout and one transaction"""
+    with _MONTH_ID_CACHE_LOCK:
+        month_id = _MONTH_ID_CACHE.get((year, month))
+    if month_id is not None:
+        return month_id
 
-            for i in range(1, 6):
-                cur.execute('INSERT INTO habits (month_id, habit_number, habit_name) VALUES (%s, %s, %s)',
-                            (month_id, i, f'Habit {i}'))
+    month_record = conn.execute(UPSERT_MONTH, {'year': year, 'month': month}).fetchone()
+    if month_record:
+        month_id, created = month_record.id, month_record.created
+    else:
+        month_id = conn.execute(
+            select(months.c.id).where(months.c.year == year, months.c.month == month)).scalar_one()
+        created = False
 
-            for day in range(1, 32):
-                cur.execute(
-                    'INSERT INTO daily_entries (month_id, day) VALUES (%s, %s)', (month_id, day))
-        else:
-            month_id = month_record[0]
+    if created:
+        # One multi-row INSERT instead of a roundtrip per habit
+        conn.execute(SEED_HABITS, {'new_month_id': month_id})
     else:
-        cur.execute(
-            'SELECT * FROM months WHERE year = ? AND month = ?', (year, month))
-        month_record = cur.fetchone()
-
-        if not month_record:
-            cur.execute(
-                'INSERT INTO months (year, month) VALUES (?, ?)', (year, month))
-            month_id = cur.lastrowid
-
-            for i in range(1, 6):
-                cur.execute('INSERT INTO habits (month_id, habit_number, habit_name) VALUES (?, ?, ?)',
-                            (month_id, i, f'Habit {i}'))
-
-            for day in range(1, 32):
-                cur.execute(
-                    'INSERT INTO daily_entries (month_id, day) VALUES (?, ?)', (month_id, day))
-        else:
-            month_id = month_record['id']
-
-    conn.commit()
-    conn.close()
+        # Only cache rows that are already committed; the caller's
+        # transaction could still roll back a month created just now
+        with _MONTH_ID_CACHE_LOCK:
+            _MONTH_ID_CACHE[(year, month)] = month_id
     return month_id
 
-# Get month data
 
+# Runs in each save's own write transaction, so the month's ETag changes
+# exactly when its data does, whatever the clocks say
+BUMP_REVISION = months.update().where(months.c.id == bindparam('bumped_month_id')).values(
+    revision=months.c.revision + 1)
+
+
+def bump_revision(conn, month_id):
+    conn.execute(BUMP_REVISION, {'bumped_month_id': month_id})
+
+# Unpack one habit from a day's habits_mask in templates
+
+
+@app.template_filter('habit_checked')
+def habit_checked(habits_mask, habit_number):
+    return bool((habits_mask or 0) >> (habit_number - 1) & 1)
 
 # Get month data
-def get_month_data(year, month):
-    month_id = get_or_create_month(year, month)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    if USE_POSTGRES:
-        # Get month info
-        cur.execute('SELECT * FROM months WHERE id = %s', (month_id,))
-        month_info = cur.fetchone()
-        month_description = [desc[0] for desc in cur.description]  # SAVE THIS!
-        
-        # Get habits
-        cur.execute(
-            'SELECT * FROM habits WHERE month_id = %s ORDER BY habit_number', (month_id,))
-        habits = cur.fetchall()
-        habits_description = [desc[0] for desc in cur.description]  # SAVE THIS!
-        
-        # Get entries
-        cur.execute(
-            'SELECT * FROM daily_entries WHERE month_id = %s ORDER BY day', (month_id,))
-        entries = cur.fetchall()
-        entries_description = [desc[0] for desc in cur.description]  # SAVE THIS!
-        
-        # Convert to dicts using SAVED descriptions
-        month_dict = dict(zip(month_description, month_info)) if month_info else {}
-        habits_list = [dict(zip(habits_description, h)) for h in habits]
-        entries_list = [dict(zip(entries_description, e)) for e in entries]
-    else:
-        # SQLite (already works correctly with row_factory)
-        cur.execute('SELECT * FROM months WHERE id = ?', (month_id,))
-        month_info = cur.fetchone()
-        cur.execute(
-            'SELECT * FROM habits WHERE month_id = ? ORDER BY habit_number', (month_id,))
-        habits = cur.fetchall()
-        cur.execute(
-            'SELECT * FROM daily_entries WHERE month_id = ? ORDER BY day', (month_id,))
-        entries = cur.fetchall()
-        
-        month_dict = dict(month_info) if month_info else {}
-        habits_list = [dict(h) for h in habits]
-        entries_list = [dict(e) for e in entries]
-    
-    conn.close()
-    
+
+# Changes with every deploy, so a new template or filter never answers 304
+# to a page rendered by the old one. Outside Vercel, hash the page's code.
+APP_VERSION = os.environ.get('VERCEL_GIT_COMMIT_SHA') or hashlib.md5(b''.join(
+    Path(path).read_bytes()
+    for path in (__file__, os.path.join(app.root_path, app.template_folder, 'index.html'))
+)).hexdigest()
+
+
+def get_month_etag(year, month):
+    """ETag for a month page from its revision counter, read in a single query"""
+    with db_reader() as conn:
+        revision = conn.execute(
+            select(months.c.revision)
+            .where(months.c.year == year, months.c.month == month)).scalar()
+    # The page also depends on today's date (past days without a journal)
+    key = f'{APP_VERSION}-{year}-{month}-{date.today()}-{revision or 0}'
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def with_etag(response, etag):
+    """Tag a month page; no-cache makes browsers revalidate so a save is never hidden"""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def read_month_data(conn, year, month):
+    """Month info, habits and saved entries, or None if the month doesn't exist yet"""
+    in_month = (months.c.year == year) & (months.c.month == month)
+    # Month info and its habits come back together in one roundtrip
+    rows = conn.execute(
+        select(months.c.id, months.c.year, months.c.month, months.c.best_day,
+               habits.c.id.label('habit_id'), habits.c.habit_number, habits.c.habit_name)
+        .select_from(months.outerjoin(habits, habits.c.month_id == months.c.id))
+        .where(in_month)
+        .order_by(habits.c.habit_number)).fetchall()
+    if not rows:
+        return None
+    # Rows arrive as mappings (the RealDictCursor / sqlite3.Row equivalent)
+    entries = conn.execute(
+        select(daily_entries)
+        .join_from(daily_entries, months, daily_entries.c.month_id == months.c.id)
+        .where(in_month)
+        .order_by(daily_entries.c.day)).mappings()
+
     return {
-        'month_info': month_dict,
-        'habits': habits_list,
-        'entries': entries_list
+        'month_info': {'id': rows[0].id, 'year': rows[0].year, 'month': rows[0].month,
+                       'best_day': rows[0].best_day},
+        'habits': [{'id': r.habit_id, 'month_id': r.id, 'habit_number': r.habit_number,
+                    'habit_name': r.habit_name} for r in rows if r.habit_id is not None],
+        'entries': [dict(e) for e in entries]
     }
 
 
+def get_month_data(year, month, etag):
+    # The ETag is read before the data, so a cached copy is never older than its key
+    cached = get_cached_month_data(year, month, etag)
+    if cached is not None:
+        return cached
+
+    # An existing month is read without a transaction; only a first visit writes
+    with db_reader() as conn:
+        data = read_month_data(conn, year, month)
+    if data is None:
+        with db_cursor() as conn:
+            get_or_create_month(conn, year, month)
+            data = read_month_data(conn, year, month)
+
+    cache_month_data(year, month, etag, data)
+    return data
+
 
 @app.route('/')
 def index():
-    init_db()
-
     now = datetime.now()
     year = request.args.get('year', now.year, type=int)
     month = request.args.get('month', now.month, type=int)
 
-    data = get_month_data(year, month)
+    # Unchanged month: answer 304 without loading the data or rendering
+    etag = get_month_etag(year, month)
+    if request.if_none_match.contains(etag):
+        return with_etag(make_response('', 304), etag)
 
-    # Add day names to entries
+    data = get_month_data(year, month, etag)
+
+    # Fill in days without a saved entry and add day names
+    saved_entries = {entry['day']: entry for entry in data['entries']}
+    day_names = get_day_names(year, month)
+    data['entries'] = [saved_entries.get(day) or dict(EMPTY_ENTRY, day=day) for day in DAYS]
     for entry in data['entries']:
-        entry['day_name'] = get_day_name(year, month, entry['day'])
+        entry['day_name'] = day_names[entry['day']]
 
     if month == 12:
         next_month, next_year = 1, year + 1
@@ -265,36 +390,28 @@ def index():
     else:
         prev_month, prev_year = month - 1, year
 
-    return render_template('index.html',
-                           current_year=year,
-                           current_month=month,
-                           month_data=data,
-                           today=date.today(),
-                           next_year=next_year,
-                           next_month=next_month,
-                           prev_year=prev_year,
-                           prev_month=prev_month)
+    return with_etag(make_response(render_template('index.html',
+                                                   current_year=year,
+                                                   current_month=month,
+                                                   month_data=data,
+                                                   today=date.today(),
+                                                   next_year=next_year,
+                                                   next_month=next_month,
+                                                   prev_year=prev_year,
+                                                   prev_month=prev_month)), etag)
 
 
 @app.route('/journal/<int:year>/<int:month>/<int:day>')
 def journal_page(year, month, day):
-    month_id = get_or_create_month(year, month)
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if USE_POSTGRES:
-        cur.execute(
-            'SELECT * FROM daily_entries WHERE month_id = %s AND day = %s', (month_id, day))
-        entry = cur.fetchone()
-        entry_dict = dict(
-            zip([desc[0] for desc in cur.description], entry)) if entry else {}
-    else:
-        cur.execute(
-            'SELECT * FROM daily_entries WHERE month_id = ? AND day = ?', (month_id, day))
-        entry = cur.fetchone()
-        entry_dict = dict(entry) if entry else {}
-
-    conn.close()
+    # Read-only: an unsaved day (or month) is rendered empty and only
+    # created by the save endpoints
+    with db_reader() as conn:
+        entry = conn.execute(
+            select(daily_entries)
+            .join_from(daily_entries, months, daily_entries.c.month_id == months.c.id)
+            .where(months.c.year == year, months.c.month == month,
+                   daily_entries.c.day == day)).mappings().first()
+        entry_dict = dict(entry) if entry else dict(EMPTY_ENTRY, day=day)
 
     return render_template('journal.html',
                            year=year,
@@ -302,26 +419,45 @@ def journal_page(year, month, day):
                            day=day,
                            entry=entry_dict)
 
+# Daily entries have no row until a day's first save, so writes are upserts
+
+
+def upsert_daily_entry(month_id, day, **values):
+    """Insert the day's row, or only overwrite the given columns if it exists"""
+    stmt = dialect_insert(daily_entries).values(month_id=month_id, day=day, **values)
+    return stmt.on_conflict_do_update(
+        index_elements=['month_id', 'day'],
+        set_={column: stmt.excluded[column] for column in values})
+
+
+def save_habit_statement(habit_bit):
+    """Upsert a day's habits_mask, clearing this habit's bit in the stored
+    mask and setting it again from the :checked_bit parameter"""
+    stmt = dialect_insert(daily_entries).values(month_id=bindparam('entry_month_id'),
+                                                day=bindparam('entry_day'),
+                                                habits_mask=bindparam('checked_bit'))
+    stored_mask = daily_entries.c.habits_mask
+    return stmt.on_conflict_do_update(
+        index_elements=['month_id', 'day'],
+        set_={'habits_mask': stored_mask.bitwise_and(~habit_bit).bitwise_or(stmt.excluded.habits_mask)})
+
+
+# One prebuilt statement per habit
+SAVE_HABIT_STATEMENTS = {i: save_habit_statement(1 << (i - 1)) for i in HABIT_NUMBERS}
+
 # API: Save one-liner
 
 
 @app.route('/api/save-oneliner', methods=['POST'])
 def save_oneliner():
     data = request.json
-    month_id = get_or_create_month(data['year'], data['month'])
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if USE_POSTGRES:
-        cur.execute('UPDATE daily_entries SET one_liner = %s WHERE month_id = %s AND day = %s',
-                    (data['text'], month_id, data['day']))
-    else:
-        cur.execute('UPDATE daily_entries SET one_liner = ? WHERE month_id = ? AND day = ?',
-                    (data['text'], month_id, data['day']))
+    if not is_valid_number(data['day'], DAYS):
+        return jsonify({'status': 'error', 'message': 'Invalid day'}), 400
 
-    conn.commit()
-    conn.close()
+    with db_cursor() as conn:
+        month_id = get_or_create_month(conn, data['year'], data['month'])
+        conn.execute(upsert_daily_entry(month_id, data['day'], one_liner=data['text']))
+        bump_revision(conn, month_id)
 
     return jsonify({'status': 'success'})
 
@@ -331,46 +467,40 @@ def save_oneliner():
 @app.route('/api/save-habit', methods=['POST'])
 def save_habit():
     data = request.json
-    month_id = get_or_create_month(data['year'], data['month'])
-    habit_col = f"habit{data['habit_number']}"
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if USE_POSTGRES:
-        cur.execute(f'UPDATE daily_entries SET {habit_col} = %s WHERE month_id = %s AND day = %s',
-                    (1 if data['checked'] else 0, month_id, data['day']))
-    else:
-        cur.execute(f'UPDATE daily_entries SET {habit_col} = ? WHERE month_id = ? AND day = ?',
-                    (1 if data['checked'] else 0, month_id, data['day']))
-
-    conn.commit()
-    conn.close()
+    if not is_valid_number(data['habit_number'], HABIT_NUMBERS):
+        return jsonify({'status': 'error', 'message': 'Invalid habit number'}), 400
+    if not is_valid_number(data['day'], DAYS):
+        return jsonify({'status': 'error', 'message': 'Invalid day'}), 400
+    stmt = SAVE_HABIT_STATEMENTS[data['habit_number']]
+    checked_bit = 1 << (data['habit_number'] - 1) if data['checked'] else 0
+
+    with db_cursor() as conn:
+        month_id = get_or_create_month(conn, data['year'], data['month'])
+        conn.execute(stmt, {'entry_month_id': month_id, 'entry_day': data['day'],
+                            'checked_bit': checked_bit})
+        bump_revision(conn, month_id)
 
     return jsonify({'status': 'success'})
 
 # API: Save detailed journal
 
+# Counts words without building a list of them first
+WORD_RE = re.compile(r'\S+')
+
 
 @app.route('/api/save-journal', methods=['POST'])
 def save_journal():
     data = request.json
-    month_id = get_or_create_month(data['year'], data['month'])
-    text = data['text']
-    word_count = len(text.split()) if text else 0
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if USE_POSTGRES:
-        cur.execute('UPDATE daily_entries SET detailed_journal = %s, word_count = %s WHERE month_id = %s AND day = %s',
-                    (text, word_count, month_id, data['day']))
-    else:
-        cur.execute('UPDATE daily_entries SET detailed_journal = ?, word_count = ? WHERE month_id = ? AND day = ?',
-                    (text, word_count, month_id, data['day']))
+    if not is_valid_number(data['day'], DAYS):
+        return jsonify({'status': 'error', 'message': 'Invalid day'}), 400
+    journal_text = data['text']
+    word_count = sum(1 for _ in WORD_RE.finditer(journal_text)) if journal_text else 0
 
-    conn.commit()
-    conn.close()
+    with db_cursor() as conn:
+        month_id = get_or_create_month(conn, data['year'], data['month'])
+        conn.execute(upsert_daily_entry(month_id, data['day'],
+                                        detailed_journal=journal_text, word_count=word_count))
+        bump_revision(conn, month_id)
 
     return jsonify({'status': 'success', 'word_count': word_count})
 
@@ -380,20 +510,16 @@ def save_journal():
 @app.route('/api/update-habit-name', methods=['POST'])
 def update_habit_name():
     data = request.json
-    month_id = get_or_create_month(data['year'], data['month'])
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if USE_POSTGRES:
-        cur.execute('UPDATE habits SET habit_name = %s WHERE month_id = %s AND habit_number = %s',
-                    (data['name'], month_id, data['habit_number']))
-    else:
-        cur.execute('UPDATE habits SET habit_name = ? WHERE month_id = ? AND habit_number = ?',
-                    (data['name'], month_id, data['habit_number']))
+    if not is_valid_number(data['habit_number'], HABIT_NUMBERS):
+        return jsonify({'status': 'error', 'message': 'Invalid habit number'}), 400
 
-    conn.commit()
-    conn.close()
+    with db_cursor() as conn:
+        month_id = get_or_create_month(conn, data['year'], data['month'])
+        conn.execute(habits.update()
+                     .where(habits.c.month_id == month_id,
+                            habits.c.habit_number == data['habit_number'])
+                     .values(habit_name=data['name']))
+        bump_revision(conn, month_id)
 
     return jsonify({'status': 'success'})
 
@@ -403,24 +529,15 @@ def update_habit_name():
 @app.route('/api/save-best-day', methods=['POST'])
 def save_best_day():
     data = request.json
-    month_id = get_or_create_month(data['year'], data['month'])
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    if USE_POSTGRES:
-        cur.execute('UPDATE months SET best_day = %s WHERE id = %s',
-                    (data['best_day'], month_id))
-    else:
-        cur.execute('UPDATE months SET best_day = ? WHERE id = ?',
-                    (data['best_day'], month_id))
-
-    conn.commit()
-    conn.close()
+    with db_cursor() as conn:
+        month_id = get_or_create_month(conn, data['year'], data['month'])
+        conn.execute(months.update()
+                     .where(months.c.id == month_id)
+                     .values(best_day=data['best_day'], revision=months.c.revision + 1))
 
     return jsonify({'status': 'success'})
 
 
 if __name__ == '__main__':
     app.run(debug=True)
-